@@ -1,14 +1,16 @@
-from flask import Flask, request, jsonify, render_template, send_file, abort
+from flask import Flask, Response, request, jsonify, render_template, send_file, send_from_directory, abort
 from flask_socketio import SocketIO
 from flask_cors import CORS
 from PIL import Image
-import io, os, sqlite3, logging
-from datetime import datetime
+import io, os, hashlib, secrets, sqlite3, logging, queue, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime, timezone
 import numpy as np
+import orjson
 import torch
 from segment_anything import sam_model_registry, SamPredictor
-import folium
-from fpdf import FPDF
 
 
 # ------------------------
@@ -38,12 +40,22 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # ------------------------
 predictor = None
 sam_loaded = False
+sam_dtype = torch.float32
+point_label = None  # the single foreground label, preallocated on the SAM device
+sam_compiled = False
+encoder_ready = False  # set by the batch worker once warm-up is done
+
+def sam_autocast():
+    """Autocast context matching the dtype SAM was loaded in."""
+    return torch.autocast(device_type="cuda", dtype=torch.bfloat16,
+                          enabled=sam_dtype == torch.bfloat16)
 
 def init_sam():
     """
     Initialize SAM model from a pre-downloaded checkpoint.
     """
-    global predictor, sam_loaded
+    global predictor, sam_loaded, sam_dtype, point_label
+    torch.set_grad_enabled(False)
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Using device: {device}")
@@ -71,11 +83,33 @@ def init_sam():
                 sam_loaded = False
                 return False
 
+        # Optional integrity check so a truncated upload/download is not loaded
+        expected_sha256 = os.environ.get('SAM_CHECKPOINT_SHA256')
+        if expected_sha256:
+            with open(checkpoint, 'rb') as fh:
+                digest = hashlib.file_digest(fh, 'sha256').hexdigest()
+            if digest != expected_sha256.lower():
+                logger.error(f"SAM checkpoint SHA256 mismatch: expected {expected_sha256}, got {digest}")
+                sam_loaded = False
+                return False
+
         # Load SAM model
         logger.info(f"Loading SAM from checkpoint: {checkpoint}")
-        sam = sam_model_registry["vit_b"](checkpoint=checkpoint)
+        sam = sam_model_registry["vit_b"](checkpoint=None)
+        sam.load_state_dict(_load_checkpoint(checkpoint))
         sam.to(device)
+        # BF16 halves memory traffic through the ViT; unlike FP16 it keeps
+        # LayerNorm stable. Only used where the GPU supports it natively.
+        if device == "cuda" and torch.cuda.is_bf16_supported():
+            sam.to(torch.bfloat16)
+            sam_dtype = torch.bfloat16
+        if device == "cuda":
+            # Inputs are always padded to 1024x1024, so autotuned conv
+            # algorithms stay valid
+            torch.backends.cudnn.benchmark = True
+            _compile_sam(sam)
         predictor = SamPredictor(sam)
+        point_label = torch.ones((1, 1), dtype=torch.int, device=device)
         sam_loaded = True
         logger.info("✅ SAM loaded successfully!")
 
@@ -86,11 +120,218 @@ def init_sam():
         sam_loaded = False
         return False
 
+def _load_checkpoint(path):
+    """
+    Load SAM weights without unpickling arbitrary objects. On torch >= 2.1
+    the file is memory-mapped so pages are read lazily instead of copied
+    into RAM up front.
+    """
+    try:
+        return torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+    except TypeError:
+        # torch < 2.1 has no mmap argument
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+def _compile_sam(sam):
+    """
+    Wrap the image encoder with torch.compile (CUDA graphs). Compilation and
+    graph capture happen lazily in _warm_up_encoder on the batch worker.
+    """
+    global sam_compiled
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    try:
+        sam.image_encoder = torch.compile(sam.image_encoder, mode="reduce-overhead")
+        sam_compiled = True
+    except Exception as e:
+        logger.warning(f"torch.compile failed, using eager SAM encoder: {e}")
+
+# ------------------------
+# SAM request batching
+# ------------------------
+# Concurrent /detect requests are queued and encoded together so the ViT
+# backbone runs once per batch instead of once per image.
+MAX_BATCH = int(os.environ.get('SAM_MAX_BATCH', 8))
+BATCH_WINDOW = 0.010  # seconds to wait for more requests before encoding
+# Matches gunicorn --timeout in render.yaml; CPU encodes are slow
+REQUEST_TIMEOUT = int(os.environ.get('SAM_REQUEST_TIMEOUT', 300))
+REQUEST_Q = queue.Queue()
+
+# Image embeddings keyed by a hash of the uploaded bytes, so clients that
+# resubmit the same frame skip the ViT backbone. Only touched by the worker.
+EMB_CACHE_SIZE = 64
+_emb_cache = OrderedDict()
+
+def _encode_batch(images):
+    """
+    Run the SAM image encoder once over a list of HxWx3 uint8 images.
+    Returns the stacked embeddings and per-image (original_size, input_size).
+    """
+    sam = predictor.model
+    on_cuda = predictor.device.type == "cuda"
+    tensors, sizes = [], []
+    for image_np in images:
+        # Upload the raw image and resize on the device rather than with PIL
+        t = torch.from_numpy(image_np)
+        if on_cuda:
+            t = t.pin_memory()
+        t = t.to(predictor.device, non_blocking=on_cuda)
+        t = t.permute(2, 0, 1)[None, :, :, :].float()
+        t = predictor.transform.apply_image_torch(t)
+        sizes.append((image_np.shape[:2], tuple(t.shape[-2:])))
+        tensors.append(sam.preprocess(t))
+    features = sam.image_encoder(torch.cat(tensors, dim=0).to(sam_dtype))
+    return features, sizes
+
+def _run_batch(items):
+    # Skip requests whose handler already gave up waiting
+    items = [item for item in items if not item[3].get('cancelled')]
+    if not items:
+        return
+    with torch.inference_mode(), sam_autocast():
+        misses = {}
+        for image_np, _, key, _ in items:
+            if key in _emb_cache:
+                _emb_cache.move_to_end(key)
+            else:
+                misses.setdefault(key, image_np)
+        if misses:
+            features, sizes = _encode_batch(list(misses.values()))
+            for i, key in enumerate(misses):
+                # Clone so the entry doesn't pin the whole batch (or a
+                # CUDA graph output buffer that the next run overwrites)
+                _emb_cache[key] = (features[i:i+1].clone(), *sizes[i])
+        for _, point, key, job in items:
+            try:
+                # Point the predictor at this image's cached embedding
+                predictor.features, predictor.original_size, predictor.input_size = _emb_cache[key]
+                predictor.is_image_set = True
+                coords = torch.tensor([[point]], dtype=torch.float, device=predictor.device)
+                coords = predictor.transform.apply_coords_torch(coords, predictor.original_size)
+                masks, scores, _ = predictor.predict_torch(
+                    point_coords=coords,
+                    point_labels=point_label,
+                    multimask_output=False
+                )
+                # Scores may be bf16, which numpy can't represent
+                job['mask'] = masks[0, 0].cpu().numpy()
+                job['score'] = float(scores[0, 0].float())
+            except Exception as e:
+                job['error'] = str(e)
+    # Evict only after the batch is served so its own entries stay available
+    while len(_emb_cache) > EMB_CACHE_SIZE:
+        _emb_cache.popitem(last=False)
+    predictor.reset_image()
+
+    done = [job for *_, job in items if 'error' not in job]
+    if done:
+        area_pixels = np.array([np.count_nonzero(job['mask']) for job in done])
+        areas, depths, severities = pothole_metrics(area_pixels)
+        for job, area_m2, depth_meters, severity in zip(done, areas, depths, severities):
+            job['area_m2'] = float(area_m2)
+            job['depth_meters'] = float(depth_meters)
+            job['severity'] = str(severity)
+    for *_, job in items:
+        job['event'].set()
+
+def _warm_up_encoder():
+    """
+    Compile and capture the encoder for every batch size from 1 to MAX_BATCH
+    (only cache misses are encoded, so any size can occur). reduce-overhead
+    mode records CUDA graphs per thread, so this runs on the batch worker
+    itself; /detect refuses work until it finishes.
+    """
+    global encoder_ready
+    sam = predictor.model
+    if sam_compiled:
+        try:
+            size = predictor.transform.target_length
+            with torch.inference_mode(), sam_autocast():
+                for batch_size in range(1, MAX_BATCH + 1):
+                    dummy = torch.zeros(batch_size, 3, size, size, device="cuda", dtype=sam_dtype)
+                    for _ in range(3):
+                        sam.image_encoder(dummy)
+            torch.cuda.synchronize()
+            logger.info("SAM image encoder compiled and warmed up")
+        except Exception as e:
+            logger.warning(f"torch.compile failed, using eager SAM encoder: {e}")
+            sam.image_encoder = sam.image_encoder._orig_mod
+    encoder_ready = True
+
+def _batch_worker():
+    # Grad mode is thread-local, so disable it for the thread running SAM
+    torch.set_grad_enabled(False)
+    _warm_up_encoder()
+    while True:
+        items = [REQUEST_Q.get()]
+        # Stacking images only adds latency on CPU; batch on GPU only
+        max_batch = MAX_BATCH if predictor.device.type == "cuda" else 1
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(items) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(REQUEST_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _run_batch(items)
+        except Exception as e:
+            logger.error(f"SAM batch inference error: {e}")
+            for *_, job in items:
+                if not job['event'].is_set():
+                    job['error'] = str(e)
+                    job['event'].set()
+
 # ------------------------
 # Database
 # ------------------------
+# Connections are opened lazily (so nothing is shared across a gunicorn
+# --preload fork) and reused: up to DB_POOL_SIZE idle readers and a single
+# lock-guarded writer, matching SQLite's one-writer/many-readers model.
+DB_POOL_SIZE = 8
+POTHOLES_LIMIT = 1000  # most recent rows returned by /potholes
+POTHOLE_KEYS = ('id', 'latitude', 'longitude', 'severity', 'area', 'depth_meters',
+                'image_path', 'confidence', 'timestamp', 'status')
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+_db_writer = None
+_db_write_lock = threading.Lock()
+
+def _connect():
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled read connection."""
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        yield conn
+    finally:
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@contextmanager
+def get_write_conn():
+    """Hold the shared write connection; writes are serialized."""
+    global _db_writer
+    with _db_write_lock:
+        if _db_writer is None:
+            _db_writer = _connect()
+        yield _db_writer
+
 def init_db():
     conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS potholes (
@@ -103,33 +344,147 @@ def init_db():
             image_path TEXT,
             confidence REAL,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'reported'
+            status TEXT DEFAULT 'reported',
+            thumb_path TEXT
         )
     ''')
+    # Databases created before thumbnails existed
+    columns = [r[1] for r in c.execute('PRAGMA table_info(potholes)')]
+    if 'thumb_path' not in columns:
+        c.execute('ALTER TABLE potholes ADD COLUMN thumb_path TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_potholes_ts ON potholes(timestamp DESC)')
     conn.commit()
     conn.close()
     logger.info("Database initialized")
 
+# Group commit: rows that queue up while a commit is in progress are
+# written together in the next one, so bursts share one WAL commit and a
+# lone insert is never delayed
+INSERT_BATCH = 32
+INSERT_TIMEOUT = 30
+_insert_q = queue.Queue()
+
+def insert_pothole(row):
+    """
+    Queue a (latitude, longitude, severity, area, depth_meters, image_path,
+    confidence, thumb_path) row for the next batched insert and return its id.
+    """
+    job = {'row': row, 'event': threading.Event()}
+    _insert_q.put(job)
+    if not job['event'].wait(timeout=INSERT_TIMEOUT):
+        raise TimeoutError("Timed out waiting for database insert")
+    if 'error' in job:
+        raise RuntimeError(job['error'])
+    return job['id']
+
+def _flusher():
+    while True:
+        batch = [_insert_q.get()]
+        while len(batch) < INSERT_BATCH:
+            try:
+                batch.append(_insert_q.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with get_write_conn() as conn:
+                conn.execute('BEGIN')
+                try:
+                    conn.executemany('''
+                        INSERT INTO potholes (latitude, longitude, severity, area, depth_meters, image_path, confidence, thumb_path)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', [job['row'] for job in batch])
+                    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            # Single writer inside one transaction, so the ids are contiguous
+            for job, pothole_id in zip(batch, range(last_id - len(batch) + 1, last_id + 1)):
+                job['id'] = pothole_id
+        except Exception as e:
+            logger.error(f"Batched insert failed: {e}")
+            for job in batch:
+                job['error'] = str(e)
+        finally:
+            for job in batch:
+                job['event'].set()
+
 # ------------------------
 # Utility
 # ------------------------
-def estimate_area(area_pixels):
-    pixels_per_meter = 100  # adjust for real calibration
-    return area_pixels / (pixels_per_meter**2)
+PIXELS_PER_METER = 100  # adjust for real calibration
+_SEVERITY_BINS = np.array([0.1, 0.3])  # m² thresholds for medium / high
+_SEVERITIES = np.array(['low', 'medium', 'high'])
+
+def pothole_metrics(area_pixels):
+    """
+    Vectorized area (m²), depth (m) and severity for an array of mask pixel
+    counts, so a whole inference batch is scored in one pass.
+    """
+    area_m2 = area_pixels / (PIXELS_PER_METER**2)
+    depth_meters = 0.05 + np.minimum(area_m2 * 0.5, 0.5)
+    severity = _SEVERITIES[np.digitize(area_m2, _SEVERITY_BINS)]
+    return area_m2, depth_meters, severity
 
-def estimate_depth(area_m2):
-    return 0.05 + min(area_m2 * 0.5, 0.5)
+_RED = np.array([255, 0, 0], dtype=np.uint8)
+THUMB_WIDTH = 600  # width of the copy embedded in PDF reports
 
-def determine_severity(area_m2):
-    if area_m2 < 0.1: return 'low'
-    if area_m2 < 0.3: return 'medium'
-    return 'high'
+def decode_image(raw):
+    return np.array(Image.open(io.BytesIO(raw)).convert('RGB'))
+
+def run_off_hub(fn, *args):
+    """
+    Run fn on one of gevent's real OS threads so the hub keeps serving other
+    requests. A monkey-patched ThreadPoolExecutor would only run greenlets,
+    so without gevent patching fn simply runs inline.
+    """
+    try:
+        import gevent
+        from gevent import monkey
+    except ImportError:
+        return fn(*args)
+    if not monkey.is_module_patched('threading'):
+        return fn(*args)
+    return gevent.get_hub().threadpool.apply(fn, args)
 
 def overlay_image(image_np, mask):
     overlay = image_np.copy()
-    overlay[mask>0] = [255,0,0]
+    overlay[np.ascontiguousarray(mask, dtype=bool)] = _RED
     return overlay
 
+# Images still being encoded in the background, keyed by filename
+_pending_images = {}
+
+def _encode_jpegs(arr, path, thumb_path):
+    img = Image.fromarray(arr)
+    tmp = path + '.tmp'
+    img.save(tmp, 'JPEG', quality=85, optimize=False, subsampling=2)
+    os.replace(tmp, path)
+    if img.width > THUMB_WIDTH:
+        img = img.resize((THUMB_WIDTH, int(THUMB_WIDTH * img.height / img.width)), Image.BILINEAR)
+    img.save(thumb_path, 'JPEG', quality=80)
+
+def _save_jpeg(arr, path, thumb_path, done):
+    try:
+        # Encode on a real thread; bookkeeping stays on this greenlet
+        run_off_hub(_encode_jpegs, arr, path, thumb_path)
+    except Exception as e:
+        logger.error(f"Failed to save {path}: {e}")
+    finally:
+        _pending_images.pop(os.path.basename(path), None)
+        done.set()
+
+def save_jpeg_async(arr, path, thumb_path):
+    """Encode arr and its thumbnail off the request; readers use wait_for_image."""
+    done = threading.Event()
+    _pending_images[os.path.basename(path)] = done
+    socketio.start_background_task(_save_jpeg, arr, path, thumb_path, done)
+
+def wait_for_image(filename, timeout=10):
+    done = _pending_images.get(filename)
+    if done is not None:
+        done.wait(timeout=timeout)
+
 # ------------------------
 # Routes
 # ------------------------
@@ -139,12 +494,18 @@ def index():
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'ok', 'sam_loaded': sam_loaded}), 200
+    if sam_loaded:
+        # Start warm-up as soon as the model is in, not on the first upload
+        _ensure_workers()
+    return jsonify({'status': 'ok', 'sam_loaded': sam_loaded and encoder_ready}), 200
 
 @app.route('/detect', methods=['POST'])
 def detect_pothole():
     if not sam_loaded:
         return jsonify({'error': 'SAM not loaded yet'}), 500
+    _ensure_workers()
+    if not encoder_ready:
+        return jsonify({'error': 'SAM is warming up, try again shortly'}), 503
     if 'image' not in request.files:
         return jsonify({'error': 'No image uploaded'}), 400
 
@@ -155,46 +516,41 @@ def detect_pothole():
     latitude = float(request.form.get('latitude', 0.0))
     longitude = float(request.form.get('longitude', 0.0))
 
-    image = Image.open(image_file.stream).convert('RGB')
-    image_np = np.array(image)
+    raw = image_file.read()
+    image_np = run_off_hub(decode_image, raw)
 
-    predictor.set_image(image_np)
     h, w = image_np.shape[:2]
-    input_point = np.array([[w//2, h//2]])
-    input_label = np.array([1])
-
-    masks, scores, _ = predictor.predict(
-        point_coords=input_point,
-        point_labels=input_label,
-        multimask_output=False
-    )
-
-    if len(masks) == 0 or masks[0].size == 0:
+    job = {'event': threading.Event()}
+    key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    REQUEST_Q.put((image_np, (w//2, h//2), key, job))
+    if not job['event'].wait(timeout=REQUEST_TIMEOUT):
+        job['cancelled'] = True
+        return jsonify({'error': 'Detection timed out'}), 504
+    if 'error' in job:
+        return jsonify({'error': job['error']}), 500
+
+    mask = job['mask']
+    if mask is None or mask.size == 0:
         return jsonify({'success': False})
 
-    mask = masks[0]
-    confidence = float(scores[0])
-    area_pixels = np.sum(mask)
-    area_m2 = estimate_area(area_pixels)
-    severity = determine_severity(area_m2)
-    depth_meters = estimate_depth(area_m2)
+    confidence = job['score']
+    area_m2, depth_meters, severity = job['area_m2'], job['depth_meters'], job['severity']
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"pothole_{timestamp}.jpg"
+    # Unique even for several detections in the same second
+    now_iso = datetime.now(timezone.utc).isoformat()
+    filename = f"pothole_{time.time_ns()}_{secrets.token_hex(4)}.jpg"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    thumb_path = filepath.replace('.jpg', '_thumb.jpg')
 
     overlay = overlay_image(image_np, mask)
-    Image.fromarray(overlay).save(filepath)
+    save_jpeg_async(overlay, filepath, thumb_path)
 
-    conn = sqlite3.connect(app.config['DATABASE'])
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO potholes (latitude, longitude, severity, area, depth_meters, image_path, confidence)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (latitude, longitude, severity, area_m2, depth_meters, filepath, confidence))
-    pothole_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    try:
+        pothole_id = insert_pothole((latitude, longitude, severity, area_m2, depth_meters, filepath, confidence, thumb_path))
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
 
     socketio.emit('new_pothole', {
         'id': pothole_id,
@@ -204,7 +560,7 @@ def detect_pothole():
         'area': area_m2,
         'depth_meters': depth_meters,
         'confidence': confidence,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': now_iso
     })
 
     return jsonify({
@@ -219,42 +575,25 @@ def detect_pothole():
 
 @app.route('/potholes')
 def get_potholes():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    c = conn.cursor()
-    c.execute('SELECT * FROM potholes ORDER BY timestamp DESC')
-    rows = c.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        result.append({
-            'id': r[0],
-            'latitude': r[1],
-            'longitude': r[2],
-            'severity': r[3],
-            'area': r[4],
-            'depth_meters': r[5],
-            'image_path': r[6],
-            'confidence': r[7],
-            'timestamp': r[8],
-            'status': r[9]
-        })
-    return jsonify(result)
+    with get_conn() as conn:
+        rows = conn.execute(f'''
+            SELECT {', '.join(POTHOLE_KEYS)}
+            FROM potholes ORDER BY timestamp DESC LIMIT ?
+        ''', (POTHOLES_LIMIT,)).fetchall()
+    return Response(orjson.dumps([dict(zip(POTHOLE_KEYS, r)) for r in rows]), mimetype='application/json')
 
 @app.route('/image/<filename>')
 def get_image(filename):
-    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(path):
-        return send_file(path)
-    return abort(404)
+    wait_for_image(filename)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True, max_age=3600)
 
 @app.route('/export/<int:pothole_id>')
 def export_pdf(pothole_id):
-    conn = sqlite3.connect(app.config['DATABASE'])
-    c = conn.cursor()
-    c.execute('SELECT * FROM potholes WHERE id=?', (pothole_id,))
-    row = c.fetchone()
-    conn.close()
+    from fpdf import FPDF  # only needed here; keeps it out of startup
+    with get_conn() as conn:
+        row = conn.execute('SELECT * FROM potholes WHERE id=?', (pothole_id,)).fetchone()
     if not row: return abort(404)
+    wait_for_image(os.path.basename(row[6]))
 
     pdf = FPDF()
     pdf.add_page()
@@ -270,33 +609,63 @@ def export_pdf(pothole_id):
     pdf.cell(0, 8, f"Confidence: {row[7]*100:.1f}%", ln=True)
     pdf.cell(0, 8, f"Timestamp: {row[8]}", ln=True)
     pdf.ln(5)
-    if os.path.exists(row[6]):
-        pdf.image(row[6], w=150)
+    # Older rows have no thumbnail; fall back to the full-size image
+    image_path = row[10] if row[10] and os.path.exists(row[10]) else row[6]
+    if os.path.exists(image_path):
+        pdf.image(image_path, w=150)
     pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"pothole_report_{row[0]}.pdf")
     pdf.output(pdf_path)
     return send_file(pdf_path)
 
+@lru_cache(maxsize=1)
+def _potholes_geojson(max_id, count):
+    # Keyed on (MAX(id), COUNT(*)) so the body is rebuilt only after the
+    # table changes
+    with get_conn() as conn:
+        rows = conn.execute('SELECT id, latitude, longitude, severity FROM potholes ORDER BY id').fetchall()
+    return orjson.dumps({
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'id': pid, 'severity': severity}
+        } for pid, lat, lon, severity in rows]
+    })
+
+@app.route('/potholes.geojson')
+def potholes_geojson():
+    with get_conn() as conn:
+        max_id, count = conn.execute('SELECT MAX(id), COUNT(*) FROM potholes').fetchone()
+    response = Response(_potholes_geojson(max_id, count), mimetype='application/geo+json')
+    response.set_etag(f"{max_id}-{count}")
+    return response.make_conditional(request)
+
 @app.route('/map')
 def show_map():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    c = conn.cursor()
-    c.execute('SELECT latitude, longitude, severity, id FROM potholes')
-    rows = c.fetchall()
-    conn.close()
-    center = (rows[0][0], rows[0][1]) if rows else (40.7128, -74.0060)
-    m = folium.Map(location=center, zoom_start=13)
-    for lat, lon, severity, pid in rows:
-        color = 'red' if severity=='high' else 'orange' if severity=='medium' else 'green'
-        folium.Marker([lat, lon], popup=f"Pothole #{pid}\nSeverity: {severity}", icon=folium.Icon(color=color)).add_to(m)
-    return m._repr_html_()
+    return render_template('map.html')
 
 # ------------------------
 # Initialization
 # ------------------------
+# Queue consumers are started lazily in the process that serves requests:
+# with gunicorn --preload the module is imported in the master, and threads
+# started there do not survive the fork into the worker.
+_workers_pid = None
+
+def _ensure_workers():
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    # Claim the process before starting: Thread.start() yields to the hub
+    # under gevent, and a second request must not start another pair. No
+    # lock here - one created at import (pre-patch) would block the hub.
+    _workers_pid = os.getpid()
+    threading.Thread(target=_batch_worker, daemon=True).start()
+    threading.Thread(target=_flusher, daemon=True).start()
+
 def initialize_app():
     init_db()
     try:
-        import threading
         threading.Thread(target=init_sam, daemon=True).start()
     except Exception as e:
         logger.error(f"Failed to start SAM background init: {str(e)}")